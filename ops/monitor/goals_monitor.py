@@ -3,16 +3,21 @@ import os
 import sys
 import json
 import time
+import atexit
+import signal
 import socket
-import urllib.request
-import urllib.error
-from datetime import datetime, timezone, timedelta
+import http.client
+from datetime import date, datetime, timezone, timedelta
+import heapq
+import mmap
+import functools
+import sched
 import statistics
 
 # Configuration from environment
 HOST_URL = os.environ.get("HOST_URL", "localhost")
-FE_URL = f"https://{HOST_URL}/"
-BE_URL = f"https://{HOST_URL}/api/auth/validate"
+FE_PATH = "/"
+BE_PATH = "/api/auth/validate"
 BOT_TOKEN = os.environ.get("TELEGRAM_BOT_TOKEN")
 CHAT_ID = os.environ.get("GOALS_SERVER_TELEGRAM_CHAT_ID")
 INTERVAL = int(os.environ.get("GOALS_MONITOR_INTERVAL_SECONDS", "60"))
@@ -21,15 +26,123 @@ RETENTION_DAYS = int(os.environ.get("GOALS_MONITOR_RETENTION_DAYS", "30"))
 
 # Paths
 BASE_DIR = os.environ.get("GOALS_MONITOR_BASE_DIR", "/var/lib/goals/monitor")
-SAMPLES_FILE = os.path.join(BASE_DIR, "samples.jsonl")
+SAMPLES_PREFIX = "samples-"
+SAMPLES_SUFFIX = ".jsonl"
 STATE_FILE = os.path.join(BASE_DIR, "state.json")
+# Pre-sharding single samples file; nothing reads it any more
+LEGACY_SAMPLES_FILE = os.path.join(BASE_DIR, "samples.jsonl")
+
+# Compact JSON for everything we write: samples, state and Telegram bodies
+_dumps = functools.partial(json.dumps, separators=(",", ":"))
+
+# Samples are buffered in memory and flushed to disk every N samples
+SAMPLES_FLUSH_EVERY = 5
 
 # Ensure base dir exists
 os.makedirs(BASE_DIR, exist_ok=True)
 
+def samples_path(date_str):
+    # Samples are sharded by UTC date: samples-YYYY-MM-DD.jsonl
+    return os.path.join(BASE_DIR, f"{SAMPLES_PREFIX}{date_str}{SAMPLES_SUFFIX}")
+
+# Open handle for the current day's shard; rotated when the date changes
+_SAMPLES_FH = None
+_SAMPLES_DATE = None
+_SAMPLES_PENDING = 0
+
+def write_sample(sample, date_str):
+    global _SAMPLES_FH, _SAMPLES_DATE, _SAMPLES_PENDING
+    if date_str != _SAMPLES_DATE:
+        close_samples()
+        # Starting a new shard is also when old ones age out of retention
+        prune_samples(date_str)
+        _SAMPLES_FH = open(samples_path(date_str), "ab", buffering=1 << 16)
+        _SAMPLES_DATE = date_str
+    _SAMPLES_FH.write(_dumps(sample).encode("utf-8") + b"\n")
+    _SAMPLES_PENDING += 1
+    if _SAMPLES_PENDING >= SAMPLES_FLUSH_EVERY:
+        _SAMPLES_FH.flush()
+        _SAMPLES_PENDING = 0
+
+def flush_samples(date_str):
+    # Push any buffered samples for date_str to disk so the shard can be read
+    global _SAMPLES_PENDING
+    if _SAMPLES_FH is not None and _SAMPLES_DATE == date_str:
+        _SAMPLES_FH.flush()
+        _SAMPLES_PENDING = 0
+
+def close_samples():
+    global _SAMPLES_FH, _SAMPLES_DATE, _SAMPLES_PENDING
+    if _SAMPLES_FH is not None:
+        _SAMPLES_FH.close()
+    _SAMPLES_FH = None
+    _SAMPLES_DATE = None
+    _SAMPLES_PENDING = 0
+
+def iter_sample_lines(path, prefix=b""):
+    # Map the shard and walk it with find(b"\n"). Lines not starting with
+    # prefix are rejected in place, so a skipped line costs a find and a
+    # byte compare; only matching lines are copied out of the mapping.
+    # json.loads accepts the resulting bytes directly.
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if hasattr(mm, "madvise"):
+                mm.madvise(mmap.MADV_SEQUENTIAL)
+            start = 0
+            while True:
+                nl = mm.find(b"\n", start)
+                end = len(mm) if nl == -1 else nl
+                if end > start and mm.find(prefix, start, start + len(prefix)) == start:
+                    yield mm[start:end]
+                if nl == -1:
+                    return
+                start = nl + 1
+
+# (idle, total) jiffies from the previous /proc/stat read
+_PREV_CPU = None
+
+def get_cpu_percent():
+    global _PREV_CPU
+    with open("/proc/stat", "rb") as f:
+        line = f.readline()
+    # user nice system idle iowait irq softirq steal guest guest_nice; guest
+    # time is already counted in user/nice so it is left out of the total
+    parts = line.split()
+    idle = int(parts[4]) + int(parts[5])
+    total = sum(map(int, parts[1:9]))
+    prev, _PREV_CPU = _PREV_CPU, (idle, total)
+    if prev is None or total <= prev[1]:
+        return 0.0
+    return round(100.0 * (1.0 - (idle - prev[0]) / (total - prev[1])), 2)
+
+def _meminfo_kb(data, key):
+    # data is the raw /proc/meminfo contents prefixed with a newline, so
+    # matching on b"\n" + key only hits the start of a line
+    p = data.find(b"\n" + key)
+    if p == -1:
+        return None
+    return int(data[p + len(key) + 1:p + len(key) + 33].split()[0])
+
+# Disk usage moves slowly; re-stat the filesystem at most every few minutes
+DISK_CACHE_SECONDS = 300
+_DISK_CACHE = (0.0, None)
+
+def get_disk_percent():
+    global _DISK_CACHE
+    expires, percent = _DISK_CACHE
+    now = time.monotonic()
+    if percent is None or now >= expires:
+        st = os.statvfs("/")
+        free = st.f_bavail * st.f_frsize
+        total = st.f_blocks * st.f_frsize
+        percent = round(100.0 * (1.0 - (free / total)), 2)
+        _DISK_CACHE = (now + DISK_CACHE_SECONDS, percent)
+    return percent
+
 def get_resource_metrics():
     metrics = {
-        "timestamp": datetime.now(timezone.utc).isoformat(),
         "cpu_percent": 0.0,
         "mem_percent": 0.0,
         "disk_percent": 0.0,
@@ -42,95 +155,119 @@ def get_resource_metrics():
     except:
         pass
 
-    # CPU Usage (approximate from /proc/stat if possible)
+    # CPU Usage (busy share of jiffies since the previous sample)
     try:
-        with open("/proc/stat", "r") as f:
-            line = f.readline()
-            if line.startswith("cpu"):
-                fields = [float(x) for x in line.split()[1:]]
-                idle = fields[3]
-                total = sum(fields)
-                # This needs two samples to be accurate, but for a daemon 
-                # we can track the previous total/idle in memory.
-                # For simplicity in this first write, we'll just log load avg 
-                # or a very basic estimate if we don't want to block.
-                # We'll use load_avg[0] as a proxy or do a 1s sleep once.
-                pass
+        metrics["cpu_percent"] = get_cpu_percent()
     except:
         pass
 
     # Memory Usage
     try:
-        with open("/proc/meminfo", "r") as f:
-            meminfo = {}
-            for line in f:
-                parts = line.split(":")
-                if len(parts) == 2:
-                    meminfo[parts[0].strip()] = int(parts[1].split()[0])
-            
-            total = meminfo.get("MemTotal", 1)
-            available = meminfo.get("MemAvailable", meminfo.get("MemFree", 0) + meminfo.get("Buffers", 0) + meminfo.get("Cached", 0))
-            metrics["mem_percent"] = round(100.0 * (1.0 - (available / total)), 2)
+        with open("/proc/meminfo", "rb") as f:
+            data = b"\n" + f.read()
+        total = _meminfo_kb(data, b"MemTotal:") or 1
+        available = _meminfo_kb(data, b"MemAvailable:")
+        if available is None:
+            available = sum(_meminfo_kb(data, key) or 0 for key in (b"MemFree:", b"Buffers:", b"Cached:"))
+        metrics["mem_percent"] = round(100.0 * (1.0 - (available / total)), 2)
     except:
         pass
 
     # Disk Usage (for root /)
     try:
-        st = os.statvfs("/")
-        free = st.f_bavail * st.f_frsize
-        total = st.f_blocks * st.f_frsize
-        metrics["disk_percent"] = round(100.0 * (1.0 - (free / total)), 2)
+        metrics["disk_percent"] = get_disk_percent()
     except:
         pass
 
     return metrics
 
-def probe_url(url):
-    start = time.time()
+# Persistent keep-alive connections, keyed by host, so we only pay for a TLS
+# handshake when the server drops the connection. Both probes share the
+# HOST_URL connection; Telegram messages share the api.telegram.org one.
+_CONNS = {}
+
+# Sent on every request; Cloudflare's Browser Integrity Check challenges
+# requests without a User-Agent, which would read as an outage
+USER_AGENT = "goals-monitor/1.0"
+
+def _get_conn(host):
+    conn = _CONNS.get(host)
+    if conn is None:
+        conn = _CONNS[host] = http.client.HTTPSConnection(host, timeout=TIMEOUT)
+    return conn
+
+def _reset_conn(host):
+    conn = _CONNS.pop(host, None)
+    if conn is not None:
+        conn.close()
+
+def _request(host, method, path, body=None, headers=None):
+    # A keep-alive connection may have been closed by the server between
+    # uses; retry once on a fresh connection before reporting an error.
+    for attempt in range(2):
+        conn = _get_conn(host)
+        try:
+            conn.request(method, path, body=body,
+                         headers={"User-Agent": USER_AGENT, **(headers or {})})
+            response = conn.getresponse()
+            # Drain the body so the socket can be reused for the next request
+            response.read()
+            if response.will_close:
+                _reset_conn(host)
+            return response.status, response.reason
+        except (http.client.RemoteDisconnected, http.client.BadStatusLine,
+                BrokenPipeError, ConnectionResetError):
+            _reset_conn(host)
+            if attempt:
+                raise
+        except Exception:
+            _reset_conn(host)
+            raise
+
+def probe_path(path, method="GET"):
+    start = time.monotonic()
     result = {
-        "url": url,
+        "url": f"https://{HOST_URL}{path}",
         "status": "DOWN",
         "code": 0,
         "latency_ms": 0,
         "error": ""
     }
     try:
+        code, reason = _request(HOST_URL, method, path)
+        result["code"] = code
+        # Redirects aren't followed, but a 3xx still means the server answered.
         # Note: /api/auth/validate will return 401 if not logged in, which is fine (Backend is UP)
-        req = urllib.request.Request(url)
-        with urllib.request.urlopen(req, timeout=TIMEOUT) as response:
-            result["code"] = response.getcode()
-            result["status"] = "UP" if result["code"] in [200, 304] else "DOWN"
-    except urllib.error.HTTPError as e:
-        result["code"] = e.code
-        # 401 is considered UP for the auth validation endpoint probe
-        if "auth/validate" in url and e.code == 401:
+        if code == 200 or 300 <= code < 400 or (path == BE_PATH and code == 401):
             result["status"] = "UP"
-        else:
-            result["status"] = "DOWN"
-        result["error"] = str(e)
+        if code >= 400:
+            result["error"] = f"HTTP Error {code}: {reason}"
     except Exception as e:
         result["error"] = str(e)
         result["status"] = "DOWN"
     
-    result["latency_ms"] = int((time.time() - start) * 1000)
+    result["latency_ms"] = int((time.monotonic() - start) * 1000)
     return result
 
+TG_HOST = "api.telegram.org"
+TG_PATH = f"/bot{BOT_TOKEN}/sendMessage"
+
 def send_telegram(text):
     if not BOT_TOKEN or not CHAT_ID:
         print(f"Skipping Telegram (not configured): {text}")
         return
     
-    url = f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage"
-    data = json.dumps({
+    data = _dumps({
         "chat_id": CHAT_ID,
         "text": text,
         "parse_mode": "Markdown"
     }).encode("utf-8")
     
     try:
-        req = urllib.request.Request(url, data=data, headers={"Content-Type": "application/json"})
-        with urllib.request.urlopen(req, timeout=TIMEOUT) as response:
-            pass
+        code, reason = _request(TG_HOST, "POST", TG_PATH, body=data,
+                                headers={"Content-Type": "application/json"})
+        if code >= 400:
+            print(f"Failed to send Telegram: HTTP Error {code}: {reason}")
     except Exception as e:
         print(f"Failed to send Telegram: {e}")
 
@@ -149,167 +286,328 @@ def load_state():
     }
 
 def save_state(state):
-    with open(STATE_FILE, "w") as f:
-        json.dump(state, f)
+    # Write to a temp file and rename over the old one so a crash mid-write
+    # never leaves a torn state.json behind
+    temp_file = STATE_FILE + ".tmp"
+    with open(temp_file, "w") as f:
+        f.write(_dumps(state))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_file, STATE_FILE)
+
+# The running counters change every sample but only need persisting every
+# few minutes; alert/summary state is written as soon as it changes.
+STATE_SAVE_SECONDS = 300
+_LAST_SAVE = (None, 0.0)
+
+def _state_key(state):
+    return (
+        state.get("last_alert_status"),
+        state.get("consecutive_failures"),
+        state.get("last_summary_date"),
+        (state.get("today") or {}).get("date")
+    )
+
+def maybe_save_state(state):
+    global _LAST_SAVE
+    key = _state_key(state)
+    last_key, last_time = _LAST_SAVE
+    now = time.monotonic()
+    if key == last_key and now - last_time < STATE_SAVE_SECONDS:
+        return
+    save_state(state)
+    _LAST_SAVE = (key, now)
 
 def calculate_percentile(data, p):
     if not data: return 0
-    data = sorted(data)
     idx = (len(data) - 1) * p / 100.0
     floor = int(idx)
-    ceil = floor + 1
-    if ceil < len(data):
-        return data[floor] + (data[ceil] - data[floor]) * (idx - floor)
-    return data[floor]
+    # Only the two ranks around idx matter, so select the shorter end of the
+    # ordering with a heap instead of sorting everything
+    if floor >= len(data) // 2:
+        tail = heapq.nlargest(len(data) - floor, data)
+        lo = tail[-1]
+        hi = tail[-2] if len(tail) > 1 else None
+    else:
+        head = heapq.nsmallest(floor + 2, data)
+        lo = head[floor]
+        hi = head[floor + 1] if len(head) > floor + 1 else None
+    if hi is not None:
+        return lo + (hi - lo) * (idx - floor)
+    return lo
+
+# P² streaming quantile estimator (Jain & Chlamtac, 1985). Tracks a single
+# percentile with 5 marker heights and positions instead of keeping every
+# observation, so it can live in state.json and be updated per sample.
+def p2_new(p):
+    return {"p": p, "count": 0, "q": [], "n": [1, 2, 3, 4, 5]}
+
+def p2_add(est, x):
+    q, n = est["q"], est["n"]
+    est["count"] += 1
+    if est["count"] <= 5:
+        q.append(x)
+        q.sort()
+        return
+
+    # Locate the cell containing x, extending the extreme markers if needed
+    if x < q[0]:
+        q[0] = x
+        k = 0
+    elif x >= q[4]:
+        q[4] = x
+        k = 3
+    else:
+        k = 0
+        while x >= q[k + 1]:
+            k += 1
+    for i in range(k + 1, 5):
+        n[i] += 1
+
+    # Nudge the middle markers towards their desired positions
+    p = est["p"] / 100.0
+    dn = (0.0, p / 2, p, (1 + p) / 2, 1.0)
+    for i in (1, 2, 3):
+        d = 1 + (est["count"] - 1) * dn[i] - n[i]
+        if (d >= 1 and n[i + 1] - n[i] > 1) or (d <= -1 and n[i - 1] - n[i] < -1):
+            d = 1 if d > 0 else -1
+            qp = q[i] + d / (n[i + 1] - n[i - 1]) * (
+                (n[i] - n[i - 1] + d) * (q[i + 1] - q[i]) / (n[i + 1] - n[i])
+                + (n[i + 1] - n[i] - d) * (q[i] - q[i - 1]) / (n[i] - n[i - 1])
+            )
+            if not q[i - 1] < qp < q[i + 1]:
+                # Parabolic prediction out of order; fall back to linear
+                qp = q[i] + d * (q[i + d] - q[i]) / (n[i + d] - n[i])
+            q[i] = qp
+            n[i] += d
+
+def p2_value(est):
+    # Until the markers are initialised they hold the raw observations
+    if est["count"] <= 5:
+        return calculate_percentile(est["q"], est["p"])
+    return est["q"][2]
+
+def stats_new():
+    return {"count": 0, "sum": 0.0, "max": 0.0, "p99": p2_new(99)}
+
+def stats_add(stats, x):
+    stats["sum"] += x
+    stats["max"] = x if stats["count"] == 0 else max(stats["max"], x)
+    stats["count"] += 1
+    p2_add(stats["p99"], x)
+
+def new_day_stats(date_str):
+    return {
+        "date": date_str,
+        "count": 0,
+        "fe_up": 0,
+        "be_up": 0,
+        "both_up": 0,
+        "fe_latency": stats_new(),
+        "be_latency": stats_new(),
+        "mem_percent": stats_new(),
+        "disk_percent": stats_new()
+    }
+
+def update_day_stats(day, sample):
+    fe_up = sample["fe_s"] == "UP"
+    be_up = sample["be_s"] == "UP"
+    day["count"] += 1
+    if fe_up:
+        day["fe_up"] += 1
+        stats_add(day["fe_latency"], sample["fe_l"])
+    if be_up:
+        day["be_up"] += 1
+        stats_add(day["be_latency"], sample["be_l"])
+    if fe_up and be_up:
+        day["both_up"] += 1
+    stats_add(day["mem_percent"], sample["mem"])
+    stats_add(day["disk_percent"], sample["disk"])
 
-def run_daily_summary(state):
-    yesterday = (datetime.now(timezone.utc) - timedelta(days=1)).strftime("%Y-%m-%d")
+def rebuild_day_stats(date_str):
+    day = new_day_stats(date_str)
+    path = samples_path(date_str)
+    # The shard may still be open for writing with samples in the buffer
+    flush_samples(date_str)
+    prefix = b'{"ts":"' + date_str.encode("ascii")
+    if os.path.exists(path):
+        # Torn or foreign lines are skipped without paying for json.loads
+        for line in iter_sample_lines(path, prefix):
+            try:
+                update_day_stats(day, json.loads(line))
+            except:
+                continue
+    return day
+
+def run_daily_summary(state, now_utc):
+    yesterday = (now_utc - timedelta(days=1)).strftime("%Y-%m-%d")
     if state.get("last_summary_date") == yesterday:
         return
     
     print(f"Generating daily summary for {yesterday}")
     
-    fe_latencies = []
-    be_latencies = []
-    mem_percents = []
-    disk_percents = []
-    
-    total_samples = 0
-    fe_up_count = 0
-    be_up_count = 0
-    both_up_count = 0
-    
-    if os.path.exists(SAMPLES_FILE):
-        with open(SAMPLES_FILE, "r") as f:
-            for line in f:
-                try:
-                    s = json.loads(line)
-                    ts = s["resources"]["timestamp"][:10]
-                    if ts != yesterday:
-                        continue
-                    
-                    total_samples += 1
-                    fe_up = s["frontend"]["status"] == "UP"
-                    be_up = s["backend"]["status"] == "UP"
-                    
-                    if fe_up:
-                        fe_up_count += 1
-                        fe_latencies.append(s["frontend"]["latency_ms"])
-                    if be_up:
-                        be_up_count += 1
-                        be_latencies.append(s["backend"]["latency_ms"])
-                    if fe_up and be_up:
-                        both_up_count += 1
-                    
-                    mem_percents.append(s["resources"]["mem_percent"])
-                    disk_percents.append(s["resources"]["disk_percent"])
-                except:
-                    continue
+    # Stats are accumulated in state as samples arrive; only fall back to
+    # rebuilding them from the shard if state doesn't cover yesterday. With
+    # a long INTERVAL no sample may have rolled the day over yet, in which
+    # case yesterday's stats are still under "today".
+    for key in ("yesterday", "today"):
+        day = state.get(key)
+        if day and day.get("date") == yesterday:
+            break
+    else:
+        day = rebuild_day_stats(yesterday)
     
+    total_samples = day["count"]
     if total_samples == 0:
         print("No samples found for yesterday.")
         state["last_summary_date"] = yesterday
         return
 
-    def fmt_stats(data):
-        if not data: return "N/A"
-        return f"Avg: {sum(data)/len(data):.1f}, Max: {max(data):.1f}, p99: {calculate_percentile(data, 99):.1f}"
+    def fmt_stats(stats):
+        if not stats["count"]: return "N/A"
+        return f"Avg: {stats['sum']/stats['count']:.1f}, Max: {stats['max']:.1f}, p99: {p2_value(stats['p99']):.1f}"
 
     msg = f"📊 *Daily Monitoring Summary: {yesterday}*\n\n"
     msg += f"📈 *Uptime*\n"
-    msg += f"• Frontend: {100.0*fe_up_count/total_samples:.2f}%\n"
-    msg += f"• Backend: {100.0*be_up_count/total_samples:.2f}%\n"
-    msg += f"• Combined: {100.0*both_up_count/total_samples:.2f}%\n\n"
+    msg += f"• Frontend: {100.0*day['fe_up']/total_samples:.2f}%\n"
+    msg += f"• Backend: {100.0*day['be_up']/total_samples:.2f}%\n"
+    msg += f"• Combined: {100.0*day['both_up']/total_samples:.2f}%\n\n"
     
     msg += f"⏱ *Latency (ms)*\n"
-    msg += f"• Frontend: {fmt_stats(fe_latencies)}\n"
-    msg += f"• Backend: {fmt_stats(be_latencies)}\n\n"
+    msg += f"• Frontend: {fmt_stats(day['fe_latency'])}\n"
+    msg += f"• Backend: {fmt_stats(day['be_latency'])}\n\n"
     
     msg += f"🖥 *Resources*\n"
-    msg += f"• Mem: {fmt_stats(mem_percents)}%\n"
-    msg += f"• Disk: {fmt_stats(disk_percents)}%\n"
+    msg += f"• Mem: {fmt_stats(day['mem_percent'])}%\n"
+    msg += f"• Disk: {fmt_stats(day['disk_percent'])}%\n"
     
     send_telegram(msg)
     state["last_summary_date"] = yesterday
-    
-    # Prune old samples
-    prune_samples()
 
-def prune_samples():
-    cutoff = (datetime.now(timezone.utc) - timedelta(days=RETENTION_DAYS)).strftime("%Y-%m-%d")
-    temp_file = SAMPLES_FILE + ".tmp"
+def prune_samples(today):
+    cutoff = (date.fromisoformat(today) - timedelta(days=RETENTION_DAYS)).isoformat()
     try:
-        with open(SAMPLES_FILE, "r") as f, open(temp_file, "w") as out:
-            for line in f:
-                try:
-                    s = json.loads(line)
-                    if s["resources"]["timestamp"][:10] >= cutoff:
-                        out.write(line)
-                except:
-                    continue
-        os.replace(temp_file, SAMPLES_FILE)
+        if os.path.exists(LEGACY_SAMPLES_FILE):
+            os.unlink(LEGACY_SAMPLES_FILE)
+        for name in os.listdir(BASE_DIR):
+            if not (name.startswith(SAMPLES_PREFIX) and name.endswith(SAMPLES_SUFFIX)):
+                continue
+            date_str = name[len(SAMPLES_PREFIX):-len(SAMPLES_SUFFIX)]
+            if date_str < cutoff:
+                os.unlink(os.path.join(BASE_DIR, name))
     except Exception as e:
         print(f"Pruning failed: {e}")
 
+def run_cycle(state):
+    try:
+        now_utc = datetime.now(timezone.utc)
+        
+        # 1. Probes
+        fe_res = probe_path(FE_PATH)
+        # The backend probe is a pure liveness check, so skip the body
+        be_res = probe_path(BE_PATH, "HEAD")
+        res_metrics = get_resource_metrics()
+        
+        # Flat record with short keys: one lookup per field when folding it
+        # into the daily stats, and fewer bytes per line in the shard
+        sample = {
+            # The timestamp leads the record so readers can filter
+            # lines by date on the raw bytes before parsing them
+            "ts": now_utc.isoformat(timespec="seconds"),
+            "fe_s": fe_res["status"],
+            "fe_c": fe_res["code"],
+            "fe_l": fe_res["latency_ms"],
+            "fe_e": fe_res["error"],
+            "be_s": be_res["status"],
+            "be_c": be_res["code"],
+            "be_l": be_res["latency_ms"],
+            "be_e": be_res["error"],
+            "cpu": res_metrics["cpu_percent"],
+            "mem": res_metrics["mem_percent"],
+            "disk": res_metrics["disk_percent"],
+            "load": res_metrics["load_avg"]
+        }
+        
+        # 2. Log
+        today = sample["ts"][:10]
+        write_sample(sample, today)
+        
+        # Fold the sample into today's running stats, rolling over at midnight UTC
+        if state.get("today", {}).get("date") != today:
+            state["yesterday"] = state.get("today")
+            state["today"] = new_day_stats(today)
+        update_day_stats(state["today"], sample)
+        
+        # 3. Alert Logic (DOWN if BOTH are down, or as you prefer? 
+        #   Let's say overall system is DOWN if either is down for 3 consecutive times)
+        is_currently_up = (fe_res["status"] == "UP" and be_res["status"] == "UP")
+        
+        if not is_currently_up:
+            state["consecutive_failures"] += 1
+            state["consecutive_successes"] = 0
+        else:
+            state["consecutive_successes"] += 1
+            state["consecutive_failures"] = 0
+        
+        # Falling edge: DOWN after 3 fails
+        if state["consecutive_failures"] == 3 and state["last_alert_status"] == "UP":
+            msg = f"🚨 *System DOWN Alert*\n\n"
+            msg += f"Frontend: {fe_res['status']} ({fe_res['code']})\n"
+            msg += f"Backend: {be_res['status']} ({be_res['code']})\n"
+            if fe_res['error']: msg += f"\nFE Error: {fe_res['error']}"
+            if be_res['error']: msg += f"\nBE Error: {be_res['error']}"
+            send_telegram(msg)
+            state["last_alert_status"] = "DOWN"
+        
+        # Recovery: UP after 3 successes
+        if state["consecutive_successes"] == 3 and state["last_alert_status"] == "DOWN":
+            send_telegram("✅ *System Recovery Notice*\n\nAll services are back online.")
+            state["last_alert_status"] = "UP"
+        
+        maybe_save_state(state)
+        
+    except Exception as e:
+        print(f"Loop error: {e}")
+
+def next_summary_delay(now_utc):
+    # Seconds until the next 00:05 UTC
+    target = now_utc.replace(hour=0, minute=5, second=0, microsecond=0)
+    if target <= now_utc:
+        target += timedelta(days=1)
+    return (target - now_utc).total_seconds()
+
 def main():
     print(f"Starting monitor for {HOST_URL} every {INTERVAL}s")
     state = load_state()
     
-    while True:
+    # Flush buffered samples and state on shutdown; systemd stops us with SIGTERM
+    atexit.register(save_state, state)
+    atexit.register(close_samples)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    
+    scheduler = sched.scheduler(time.monotonic, time.sleep)
+    
+    # Probe on a fixed monotonic cadence so the time spent probing doesn't
+    # push later samples back; skip ahead rather than burst after an overrun
+    def cycle(next_tick):
+        run_cycle(state)
+        next_tick = max(next_tick + INTERVAL, time.monotonic())
+        scheduler.enterabs(next_tick, 0, cycle, (next_tick,))
+    
+    # Daily summary at 00:05 UTC. Also runs once at startup, which is a no-op
+    # unless yesterday's summary was missed while we were down.
+    def daily():
+        now_utc = datetime.now(timezone.utc)
         try:
-            # 1. Probes
-            fe_res = probe_url(FE_URL)
-            be_res = probe_url(BE_URL)
-            res_metrics = get_resource_metrics()
-            
-            sample = {
-                "frontend": fe_res,
-                "backend": be_res,
-                "resources": res_metrics
-            }
-            
-            # 2. Log
-            with open(SAMPLES_FILE, "a") as f:
-                f.write(json.dumps(sample) + "\n")
-            
-            # 3. Alert Logic (DOWN if BOTH are down, or as you prefer? 
-            #   Let's say overall system is DOWN if either is down for 3 consecutive times)
-            is_currently_up = (fe_res["status"] == "UP" and be_res["status"] == "UP")
-            
-            if not is_currently_up:
-                state["consecutive_failures"] += 1
-                state["consecutive_successes"] = 0
-            else:
-                state["consecutive_successes"] += 1
-                state["consecutive_failures"] = 0
-            
-            # Falling edge: DOWN after 3 fails
-            if state["consecutive_failures"] == 3 and state["last_alert_status"] == "UP":
-                msg = f"🚨 *System DOWN Alert*\n\n"
-                msg += f"Frontend: {fe_res['status']} ({fe_res['code']})\n"
-                msg += f"Backend: {be_res['status']} ({be_res['code']})\n"
-                if fe_res['error']: msg += f"\nFE Error: {fe_res['error']}"
-                if be_res['error']: msg += f"\nBE Error: {be_res['error']}"
-                send_telegram(msg)
-                state["last_alert_status"] = "DOWN"
-            
-            # Recovery: UP after 3 successes
-            if state["consecutive_successes"] == 3 and state["last_alert_status"] == "DOWN":
-                send_telegram("✅ *System Recovery Notice*\n\nAll services are back online.")
-                state["last_alert_status"] = "UP"
-            
-            # 4. Daily Summary Check (00:05 UTC)
-            now_utc = datetime.now(timezone.utc)
-            if now_utc.hour == 0 and now_utc.minute >= 5:
-                run_daily_summary(state)
-            
-            save_state(state)
-            
+            run_daily_summary(state, now_utc)
+            maybe_save_state(state)
         except Exception as e:
-            print(f"Loop error: {e}")
-            
-        time.sleep(INTERVAL)
+            print(f"Daily summary error: {e}")
+        scheduler.enter(next_summary_delay(now_utc), 1, daily)
+    
+    scheduler.enter(0, 0, cycle, (time.monotonic(),))
+    scheduler.enter(0, 1, daily)
+    scheduler.run()
 
 if __name__ == "__main__":
     main()
-